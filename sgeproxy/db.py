@@ -149,24 +149,28 @@ class User(Base):
             .filter(ConsentUsagePoint.usage_point_id == usage_point)
         )
 
-        if query.limit(1).count() == 0:
+        # A user only has a few consents for a usage point, all of them are
+        # fetched at once and checked here rather than with a query per check
+        consents = query.all()
+
+        if not consents:
             raise PermissionError(f"No consent registered for {usage_point}")
 
-        query = query.filter(call_date >= Consent.begins_at)
+        consents = [c for c in consents if call_date >= c.begins_at]
 
-        if query.limit(1).count() == 0:
+        if not consents:
             raise PermissionError(
                 f"Consent registered for {usage_point} is not valid yet"
             )
 
-        query = query.filter(call_date < Consent.expires_at)
+        consents = [c for c in consents if call_date < c.expires_at]
 
-        if query.limit(1).count() == 0:
+        if not consents:
             raise PermissionError(
                 f"Consent registered for {usage_point} is no longer valid"
             )
 
-        return query.first()
+        return consents[0]
 
 
 class UsagePoint(Base):
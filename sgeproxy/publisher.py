@@ -149,11 +149,15 @@ class StreamsFiles:
             logging.error(f"No handler for file {path}")
             return
 
+        # Streams are parsed on the fly and might fail after some records,
+        # nothing is yielded until the whole file is parsed
+        records: List[Tuple[SgeProxyMeta, Record]] = []
         with self.open(path) as data_files:
             for data_file in data_files:
                 stream = stream_handler(data_file)
-                for metadata, record in stream.records():
-                    yield metadata, record  # or yield stream.records()?
+                records.extend(stream.records())
+
+        yield from records
 
         self.archive(path)
 
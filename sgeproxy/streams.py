@@ -1,6 +1,20 @@
+from dataclasses import dataclass
+import functools
 import logging
 import statistics
-from typing import Dict, Iterable, Optional, List, Tuple, Union
+import sys
+from typing import (
+    BinaryIO,
+    Callable,
+    Counter,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 import xml.etree.ElementTree as ET
 import datetime as dt
 import pytz
@@ -16,6 +30,8 @@ from sgeproxy.metadata_enedis import (
     MetadataEnedisConsumptionVoltageRaw,
 )
 
+PARIS_TZ = pytz.timezone("Europe/Paris")
+
 
 def _find_element(parent: Union[ET.ElementTree, ET.Element], tag: str) -> ET.Element:
     found = parent.find(tag)
@@ -28,157 +44,195 @@ def _find_optional_element(parent: ET.Element, tag: str) -> Optional[ET.Element]
 
 
 def _find_text(parent: ET.Element, tag: str) -> str:
-    found = _find_element(parent, tag)
-    assert found.text is not None, f"{tag} does not embed text"
-    return found.text
+    # Single C call, findtext gives "" for an element without text
+    text = parent.findtext(tag)
+    assert text is not None, f"Unable to find {tag}"
+    assert text, f"{tag} does not embed text"
+    return text
 
 
-RecordName = str
-UsagePoint = str
+# Same timestamps come back for each series and temporal class of a file,
+# datetimes are immutable so parsed values can be shared.
+@functools.lru_cache(maxsize=4096)
+def _parse_datetime(datetime_str: str) -> dt.datetime:
+    return dt.datetime.fromisoformat(datetime_str)
 
 
-class R171:
-    def __init__(self, xml_doc: str) -> None:
-        self.doc = ET.parse(xml_doc)
+# For timestamps without offset, localizing goes through pytz DST
+# resolution, it is memoized along with parsing.
+@functools.lru_cache(maxsize=4096)
+def _parse_paris_datetime(datetime_str: str) -> dt.datetime:
+    return PARIS_TZ.localize(dt.datetime.fromisoformat(datetime_str))
 
-    def records(self) -> Iterable[Tuple[Metadata, Record]]:
 
-        computed_records: Dict[
-            UsagePoint, Dict[dt.datetime, Dict[RecordName, Tuple[Metadata, Record]]]
-        ] = {}
-
-        for series in self.doc.findall(".//serieMesuresDatees"):
-            usage_point = _find_text(series, "prmId")
-            direction = _find_text(series, "grandeurMetier")
-            if direction == "CONS":
-                direction = "consumption"
-            elif direction == "PROD":
-                # FIXME(cyril) check this
-                direction = "production"
-            else:
-                raise RuntimeError(f"Unexpected direction {direction}")
+UsagePoint = str
 
-            measurement_code = _find_text(series, "grandeurPhysique")
-            unit = _find_text(series, "unite")
-            temporal_class = _find_text(series, "codeClasseTemporelle").lower()
-            temporal_class_owner = _find_text(series, "typeCalendrier")
 
-            if temporal_class_owner == "D":
-                temporal_class_owner = "distributor"
-            else:
-                raise RuntimeError("Is this supposed to happen?")
+@dataclass
+class _ComputedValues:
+    # Only values are accumulated, records are built once all series are read
+    pmax: Optional[int] = None
+    ea: Optional[int] = None
 
-            base_name = f"urn:dev:prm:{usage_point}_{direction}"
-            ea_meta = MetadataEnedisConsumptionEnergyActiveIndex(usage_point)
-            pmax_meta = MetadataEnedisConsumptionPowerApparentMax(usage_point)
 
-            if measurement_code == "PMA":
-                name = (
-                    base_name
-                    + f"/power/apparent/max/{temporal_class_owner}/{temporal_class}"
-                )
-                meta: Metadata = pmax_meta
-            elif measurement_code == "EA":
-                name = (
-                    base_name
-                    + f"/energy/active/index/{temporal_class_owner}/{temporal_class}"
-                )
-                meta = ea_meta
-            else:
-                # Data type not handled
-                # EA Energie Active
-                # PMA Puissance Maximale Atteinte
-                # ERC Energie Réactive Capacitive ERI Energie Réactive Inductive
-                # ER Energie Réactive
-                # TF Temps de Fonctionnement
-                # DD Durée de Dépassement
-                # DE Dépassement Energétique
-                # DQ Dépassement Quadratique
-                continue
+class R171:
+    def __init__(self, xml_doc: Union[str, BinaryIO]) -> None:
+        # R171 files are the largest, they are streamed rather than loaded
+        self.xml_doc = xml_doc
 
-            assert unit == meta.measurement.unit.value
+    def records(self) -> Iterable[Tuple[Metadata, Record]]:
 
-            for measurement in series.findall(".//mesureDatee"):
-                # TODO(cyril) PMAX is relevant over a period of time, should be
-                # stamped at the begining.
-                time_str = _find_text(measurement, "dateFin")
-                value = int(_find_text(measurement, "valeur"))
-                # TODO(cyril) check that datetime is actually Paris time
-                # No time zone is specified in R171
-                # Most of the other files mention it, and its Paris time
-                time = dt.datetime.fromisoformat(time_str)
-                time = pytz.timezone("Europe/Paris").localize(time)
+        computed_values: Dict[Tuple[UsagePoint, dt.datetime], _ComputedValues] = {}
 
-                yield meta, Record(name, time, unit, value)
+        # Metadata are frozen, a single instance per usage point is shared by
+        # all the series of the file
+        pmax_metas: Dict[UsagePoint, MetadataEnedisConsumptionPowerApparentMax] = {}
+        ea_metas: Dict[UsagePoint, MetadataEnedisConsumptionEnergyActiveIndex] = {}
 
-                # Autocomputed records
+        for _, element in ET.iterparse(self.xml_doc):
+            if element.tag == "serieMesuresDatees":
+                yield from self._series_records(
+                    element, computed_values, pmax_metas, ea_metas
+                )
+                # Series is not needed anymore, free its measurements
+                element.clear()
+
+        # Names and metadata only depend on the usage point, and values are
+        # grouped by usage point as series are
+        current_usage_point = None
+        for (usage_point, time), computed in computed_values.items():
+            if usage_point != current_usage_point:
+                current_usage_point = usage_point
+                base_name = f"urn:dev:prm:{usage_point}_consumption"
+                pmax_name = sys.intern(f"{base_name}/power/apparent/max")
+                ea_name = sys.intern(f"{base_name}/energy/active/index")
+                pmax_meta = MetadataEnedisConsumptionPowerApparentMax(usage_point)
+                ea_meta = MetadataEnedisConsumptionEnergyActiveIndex(usage_point)
+                pmax_unit = pmax_meta.measurement.unit.value
+                ea_unit = ea_meta.measurement.unit.value
+
+            assert computed.pmax is not None, "Unable to compute record"
+            assert computed.ea is not None, "Unable to compute record"
+            yield pmax_meta, Record(pmax_name, time, pmax_unit, computed.pmax)
+            yield ea_meta, Record(ea_name, time, ea_unit, computed.ea)
+
+    def _series_records(
+        self,
+        series: ET.Element,
+        computed_values: Dict[Tuple[UsagePoint, dt.datetime], _ComputedValues],
+        pmax_metas: Dict[UsagePoint, MetadataEnedisConsumptionPowerApparentMax],
+        ea_metas: Dict[UsagePoint, MetadataEnedisConsumptionEnergyActiveIndex],
+    ) -> Iterable[Tuple[Metadata, Record]]:
+
+        # Series are filtered first, unhandled ones are not read any further
+        measurement_code = _find_text(series, "grandeurPhysique")
+        if measurement_code not in ("PMA", "EA"):
+            # Data type not handled
+            # EA Energie Active
+            # PMA Puissance Maximale Atteinte
+            # ERC Energie Réactive Capacitive ERI Energie Réactive Inductive
+            # ER Energie Réactive
+            # TF Temps de Fonctionnement
+            # DD Durée de Dépassement
+            # DE Dépassement Energétique
+            # DQ Dépassement Quadratique
+            return
+
+        usage_point = _find_text(series, "prmId")
+        direction = _find_text(series, "grandeurMetier")
+        if direction == "CONS":
+            direction = "consumption"
+        elif direction == "PROD":
+            # FIXME(cyril) check this
+            direction = "production"
+        else:
+            raise RuntimeError(f"Unexpected direction {direction}")
 
-                if usage_point not in computed_records:
-                    computed_records[usage_point] = {}
+        unit = _find_text(series, "unite")
+        temporal_class = _find_text(series, "codeClasseTemporelle").lower()
+        temporal_class_owner = _find_text(series, "typeCalendrier")
 
-                base_name = f"urn:dev:prm:{usage_point}_consumption"
+        if temporal_class_owner == "D":
+            temporal_class_owner = "distributor"
+        else:
+            raise RuntimeError("Is this supposed to happen?")
 
-                if time not in computed_records[usage_point]:
-                    computed_records[usage_point][time] = {
-                        "power/apparent/max": (
-                            pmax_meta,
-                            Record(
-                                f"{base_name}/power/apparent/max",
-                                time,
-                                None,
-                                None,
-                            ),
-                        ),
-                        "energy/active/index": (
-                            ea_meta,
-                            Record(
-                                f"{base_name}/energy/active/index",
-                                time,
-                                None,
-                                None,
-                            ),
-                        ),
-                    }
-
-                if temporal_class_owner != "distributor":
-                    # Use data from distributor counters
-                    # (arbitrary, result should be the same with provider)
-                    # TODO(cyril) check that distributor is always present in file
-                    # (provider is not)
-                    continue
-
-                if direction != "consumption":
-                    # Only compute records for consumption for now
-                    continue
-
-                if measurement_code == "PMA":
-                    meta, record = computed_records[usage_point][time][
-                        "power/apparent/max"
-                    ]
-                    if record.unit is None:
-                        record.unit = unit
-                    assert record.unit == meta.measurement.unit.value
-                    if record.value is None or record.value < value:
-                        record.value = value
-
-                elif measurement_code == "EA":
-                    # TODO(cyril) check that sum is actually the main index
-                    meta, record = computed_records[usage_point][time][
-                        "energy/active/index"
-                    ]
-                    if record.unit is None:
-                        record.unit = unit
-                    assert record.unit == meta.measurement.unit.value
-                    if record.value is None:
-                        record.value = value
-                    else:
-                        record.value += value
+        base_name = f"urn:dev:prm:{usage_point}_{direction}"
 
-        for usage_point in computed_records:
-            for time, records in computed_records[usage_point].items():
-                for meta, record in records.values():
-                    assert record.value is not None, "Unable to compute record"
-                    yield meta, record
+        if measurement_code == "PMA":
+            name = (
+                base_name
+                + f"/power/apparent/max/{temporal_class_owner}/{temporal_class}"
+            )
+            if usage_point not in pmax_metas:
+                pmax_metas[usage_point] = MetadataEnedisConsumptionPowerApparentMax(
+                    usage_point
+                )
+            meta: Metadata = pmax_metas[usage_point]
+        else:
+            name = (
+                base_name
+                + f"/energy/active/index/{temporal_class_owner}/{temporal_class}"
+            )
+            if usage_point not in ea_metas:
+                ea_metas[usage_point] = MetadataEnedisConsumptionEnergyActiveIndex(
+                    usage_point
+                )
+            meta = ea_metas[usage_point]
+
+        assert unit == meta.measurement.unit.value
+
+        # Name only depends on the series, share it between its records
+        name = sys.intern(name)
+
+        # Use data from distributor counters
+        # (arbitrary, result should be the same with provider)
+        # TODO(cyril) check that distributor is always present in file
+        # (provider is not)
+        # Only compute records for consumption for now
+        computes = temporal_class_owner == "distributor" and direction == "consumption"
+
+        is_pmax = measurement_code == "PMA"
+
+        # iter walks the subtree in C, findall(".//...") goes through the
+        # Python path engine
+        for measurement in series.iter("mesureDatee"):
+            # TODO(cyril) PMAX is relevant over a period of time, should be
+            # stamped at the begining.
+            # Hot loop, look children up directly rather than through
+            # _find_text, findtext does it without Python level calls
+            time_str = measurement.findtext("dateFin")
+            value_str = measurement.findtext("valeur")
+            assert time_str and value_str, "Incomplete mesureDatee"
+            value = int(value_str)
+            # TODO(cyril) check that datetime is actually Paris time
+            # No time zone is specified in R171
+            # Most of the other files mention it, and its Paris time
+            time = _parse_paris_datetime(time_str)
+
+            yield meta, Record(name, time, unit, value)
+
+            # Autocomputed records
+
+            # Checked first, times only measured by series that are not used
+            # for computation must not expect computed records
+            if not computes:
+                continue
+
+            key = (usage_point, time)
+            computed = computed_values.get(key)
+            if computed is None:
+                computed = computed_values[key] = _ComputedValues()
+
+            if is_pmax:
+                if computed.pmax is None or value > computed.pmax:
+                    computed.pmax = value
+            else:
+                # TODO(cyril) check that sum is actually the main index
+                if computed.ea is None:
+                    computed.ea = value
+                else:
+                    computed.ea += value
 
 
 class R151:
@@ -187,7 +241,7 @@ class R151:
 
     def records(self) -> Iterable[Tuple[Metadata, Record]]:
 
-        for prm in self.doc.findall(".//PRM"):
+        for prm in self.doc.iter("PRM"):
             usage_point = _find_text(prm, "Id_PRM")
             # FIXME(cyril) Nothing specified in this stream?
             # TODO(cyril) Check on a production usage point
@@ -202,8 +256,7 @@ class R151:
             # TODO(cyril) specify what we want
             # like 2022-03-17
             time_str = _find_text(data, "Date_Releve")
-            time = dt.datetime.fromisoformat(time_str)
-            time = pytz.timezone("Europe/Paris").localize(time)
+            time = _parse_paris_datetime(time_str)
 
             base_name = f"urn:dev:prm:{usage_point}_{direction}"
 
@@ -211,13 +264,13 @@ class R151:
             index_sum = 0
 
             temporal_class_owner = "distributor"
-            for temporal_class in data.findall("./Classe_Temporelle_Distributeur"):
+            for temporal_class in data.findall("Classe_Temporelle_Distributeur"):
 
                 value = int(_find_text(temporal_class, "Valeur"))
                 temporal_class_id = _find_text(
                     temporal_class, "Id_Classe_Temporelle"
                 ).lower()
-                name = (
+                name = sys.intern(
                     base_name
                     + f"/energy/active/index/{temporal_class_owner}/{temporal_class_id}"
                 )
@@ -233,13 +286,13 @@ class R151:
             yield ea_meta, record
 
             temporal_class_owner = "provider"
-            for temporal_class in data.findall("./Classe_Temporelle"):
+            for temporal_class in data.findall("Classe_Temporelle"):
                 value = int(_find_text(temporal_class, "Valeur"))
                 temporal_class_id = _find_text(
                     temporal_class, "Id_Classe_Temporelle"
                 ).lower()
                 unit = "Wh"
-                name = (
+                name = sys.intern(
                     base_name
                     + f"/energy/active/index/{temporal_class_owner}/{temporal_class_id}"
                 )
@@ -265,155 +318,251 @@ class R151:
 # Multiple files per zip archive
 # Multiple PRMs per files
 class R50:
-    def __init__(self, xml_doc: str) -> None:
-        self.doc = ET.parse(xml_doc)
 
-    def records(self) -> Iterable[Tuple[Metadata, Record]]:
+    SAMPLING_INTERVAL = SamplingInterval("PT30M")
 
-        header = _find_element(self.doc, "En_Tete_Flux")
-        period_minutes = int(_find_text(header, "Pas_Publication"))
+    def __init__(self, xml_doc: Union[str, BinaryIO]) -> None:
+        # PRMs are streamed rather than loaded, see R171
+        self.xml_doc = xml_doc
 
-        # Spec says its always 30 min but I thought this could be an hour too
-        assert period_minutes == 30
-
-        for prm in self.doc.findall("./PRM"):
-            usage_point = _find_text(prm, "Id_PRM")
-            # FIXME(cyril) Nothing specified in this stream?
-            # TODO(cyril) Check on a production usage point
-            # (check in stream doc and commande collecte before)
-            direction = "consumption"
+    def records(self) -> Iterable[Tuple[Metadata, Record]]:
 
-            meta = MetadataEnedisConsumptionPowerActiveRaw(
-                usage_point, SamplingInterval("PT30M")
+        # En_Tete_Flux comes before the PRMs in the document, the period is
+        # known by the time the first PRM is complete
+        period: Optional[dt.timedelta] = None
+
+        for _, element in ET.iterparse(self.xml_doc):
+            if element.tag == "PRM":
+                assert period is not None, "Missing En_Tete_Flux"
+                yield from self._prm_records(element, period)
+                # PRM is not needed anymore, free its points
+                element.clear()
+            elif element.tag == "En_Tete_Flux":
+                period_minutes = int(_find_text(element, "Pas_Publication"))
+                # Spec says its always 30 min but I thought this could be an
+                # hour too
+                assert period_minutes == 30
+                period = dt.timedelta(minutes=period_minutes)
+
+    def _prm_records(
+        self, prm: ET.Element, period: dt.timedelta
+    ) -> Iterable[Tuple[Metadata, Record]]:
+
+        usage_point = _find_text(prm, "Id_PRM")
+        # FIXME(cyril) Nothing specified in this stream?
+        # TODO(cyril) Check on a production usage point
+        # (check in stream doc and commande collecte before)
+        direction = "consumption"
+
+        meta = MetadataEnedisConsumptionPowerActiveRaw(
+            usage_point, self.SAMPLING_INTERVAL
+        )
+
+        name = f"urn:dev:prm:{usage_point}_{direction}/power/active/raw"
+
+        # Held back until the period is checked, so that a rejected PRM does
+        # not publish any of its points
+        records: List[Record] = []
+
+        # Reported once per usage point rather than for each point
+        cautions: Counter[int] = Counter()
+
+        for pdc in prm.findall("./Donnees_Releve/PDC"):
+            datetime_str = pdc.findtext("H")
+            value_str = pdc.findtext("V")
+            caution_str = pdc.findtext("IV")
+            assert datetime_str and value_str and caution_str, "Incomplete PDC"
+            value = int(value_str)
+            caution = int(caution_str)
+
+            if caution:
+                cautions[caution] += 1
+
+            datetime = _parse_datetime(datetime_str)
+
+            # Data from file is stamped at the end of periods,
+            # quoalise timestamp them at the begining
+            datetime = datetime - period
+
+            records.append(Record(name, datetime, "W", value))
+
+        # Some points might be missing or off the grid, the period of most
+        # of them is checked
+        datetimes = sorted(record.time for record in records)
+        periods = [b - a for a, b in zip(datetimes, datetimes[1:])]
+        if periods:
+            period_median = statistics.median(
+                [int(p.total_seconds() / 60) for p in periods]
+            )
+            assert period_median == int(
+                period.total_seconds() / 60
+            ), f"Unexpected period {period_median} min for {usage_point}"
+
+        for caution, count in cautions.items():
+            logging.warning(
+                "caution %s is not handled yet (%s, %d points)",
+                caution,
+                usage_point,
+                count,
             )
 
-            name = f"urn:dev:prm:{usage_point}_{direction}/power/active/raw"
-
-            # Just to check time period
-            records: List[Tuple[dt.datetime, int]] = []
-
-            for pdc in prm.findall("./Donnees_Releve/PDC"):
-                datetime_str = _find_text(pdc, "H")
-                value = int(_find_text(pdc, "V"))
-                caution = int(_find_text(pdc, "IV"))
+        for record in records:
+            yield meta, record
 
-                if caution:
-                    logging.warn(f"caution {caution} is not handled yet")
 
-                datetime = dt.datetime.fromisoformat(datetime_str)
+class _R4xMeasurement(NamedTuple):
+    name: str
+    metadata_class: Callable[[UsagePoint, SamplingInterval], Metadata]
+    # Unit expected in the file, not checked if None
+    source_unit: Optional[str]
+    # Unit of the records, same as the file if None
+    unit: Optional[str]
+    # sge tiers proxy uses W, not kW
+    scale: int
 
-                # Data from file is stamped at the end of periods,
-                # quoalise timestamp them at the begining
-                datetime = datetime - dt.timedelta(minutes=period_minutes)
 
-                records.append((datetime, value))
+class R4x:
 
-            datetimes = sorted(datetime for datetime, _ in records)
-            periods = [j - i for i in datetimes[:-1] for j in datetimes[1:]]
-            if periods:
-                period_median = statistics.median(
-                    [int(p.total_seconds() / 60) for p in periods]
-                )
-                assert period_median == period_minutes
+    SAMPLING_INTERVAL = SamplingInterval("PT10M")
 
-            for datetime, value in records:
-                record = Record(name, datetime, "W", value)
+    # Everything depending on Grandeur_Physique is resolved once per curve,
+    # the points loop is the same for all measurements
+    MEASUREMENTS = {
+        "EA": _R4xMeasurement(
+            "power/active", MetadataEnedisConsumptionPowerActiveRaw, "kW", "W", 1000
+        ),
+        # TODO ERC and ERI seem to be kVAr, expected kWr
+        "ERC": _R4xMeasurement(
+            "power/capacitive",
+            MetadataEnedisConsumptionPowerCapacitiveRaw,
+            None,
+            "Wr",
+            1000,
+        ),
+        "ERI": _R4xMeasurement(
+            "power/inductive",
+            MetadataEnedisConsumptionPowerInductiveRaw,
+            None,
+            "Wr",
+            1000,
+        ),
+        "E": _R4xMeasurement(
+            "voltage", MetadataEnedisConsumptionVoltageRaw, None, None, 1
+        ),
+    }
+
+    def __init__(self, xml_doc: Union[str, BinaryIO]) -> None:
+        # Curves are streamed rather than loaded, see R171
+        self.xml_doc = xml_doc
 
-                yield meta, record
+    def records(self) -> Iterable[Tuple[Metadata, Record]]:
 
+        # Entete and Identifiant_PRM come before the curves in the document,
+        # they are known by the time the first curve is complete
+        nature: Optional[str] = None
+        usage_point: Optional[str] = None
+        body_found = False
 
-class R4x:
+        # Tags of the elements being parsed, so that only children of the
+        # root and of Corps are picked, as when the tree was searched
+        path: List[str] = []
 
-    SAMPLING_INTERVAL = SamplingInterval("PT10M")
+        for event, element in ET.iterparse(self.xml_doc, events=("start", "end")):
+            if event == "start":
+                path.append(element.tag)
+                continue
+            path.pop()
+
+            if len(path) == 2 and path[1] == "Corps":
+                if element.tag == "Donnees_Courbe":
+                    assert nature is not None, "Missing Entete"
+                    assert usage_point is not None, "Missing Identifiant_PRM"
+                    yield from self._curve_records(element, nature, usage_point)
+                    # Curve is not needed anymore, free its points
+                    element.clear()
+                elif element.tag == "Identifiant_PRM":
+                    usage_point = element.text
+                    assert usage_point, "Identifiant_PRM does not embed text"
+            elif len(path) == 1:
+                if element.tag == "Entete":
+                    nature = _find_text(element, "Nature_De_Courbe_Demandee")
+                    if nature == "Brute":
+                        nature = "raw"
+                    else:
+                        raise RuntimeError(f"Nature {nature} is not supported yet")
+                elif element.tag == "Corps":
+                    body_found = True
 
-    def __init__(self, xml_doc: str) -> None:
-        self.doc = ET.parse(xml_doc)
+        assert body_found, "Unable to find Corps"
 
-    def records(self) -> Iterable[Tuple[Metadata, Record]]:
+    def _curve_records(
+        self, curve: ET.Element, nature: str, usage_point: UsagePoint
+    ) -> Iterable[Tuple[Metadata, Record]]:
 
-        header = _find_element(self.doc, "Entete")
-        nature = _find_text(header, "Nature_De_Courbe_Demandee")
-        if nature == "Brute":
-            nature = "raw"
-        else:
-            raise RuntimeError(f"Nature {nature} is not supported yet")
+        unit = _find_text(curve, "Unite_Mesure")
 
-        body = _find_element(self.doc, "Corps")
-        usage_point = _find_text(body, "Identifiant_PRM")
+        period = int(_find_text(curve, "Granularite"))
+        assert period == 10  # From spec
 
-        for curve in body.findall("./Donnees_Courbe"):
+        direction = _find_text(curve, "Grandeur_Metier")
+        if direction == "CONS":
+            direction = "consumption"
+        elif direction == "PROD":
+            direction = "production"
+
+        measurement = _find_text(curve, "Grandeur_Physique")
+        try:
+            spec = self.MEASUREMENTS[measurement]
+        except KeyError:
+            raise RuntimeError(f"Unexpected Grandeur {measurement}")
+
+        if spec.source_unit is not None:
+            assert unit == spec.source_unit
+        if spec.unit is not None:
+            unit = spec.unit  # Value will be converted
+        scale = spec.scale
+
+        meta = spec.metadata_class(usage_point, self.SAMPLING_INTERVAL)
+        name = f"urn:dev:prm:{usage_point}_{direction}/{spec.name}/{nature}"
+
+        # Reported once per curve rather than for each point
+        skipped: Counter[str] = Counter()
+
+        # A plain tag is matched in C, "./" paths go through ElementPath
+        for point in curve.findall("Donnees_Point_Mesure"):
+
+            attrib = point.attrib
+
+            # Check status first, skipped points do not need to be parsed
+            status = attrib["Statut_Point"]
+
+            if status != "R":
+                # R : Réel
+                # H : Puissance reconstituée
+                # P : Puissance reconstituée et Coupure Secteur
+                # S : Coupure secteur
+                # T : Coupure Secteur courte
+                # F : Début coupure secteur
+                # G : Fin de coupure secteur
+                # E : Estimé
+                # C : Corrigé
+                # K : Calculé, point de courbe issu d’un calcul basé sur
+                #     d’autres courbes de charges
+                # D : importé manuellement par le métier Enedis
+                skipped[status] += 1
+                continue
 
-            unit = _find_text(curve, "Unite_Mesure")
+            datetime = _parse_datetime(attrib["Horodatage"])
+            value = int(attrib["Valeur_Point"]) * scale
 
-            period = int(_find_text(curve, "Granularite"))
-            assert period == 10  # From spec
+            record = Record(name, datetime, unit, value)
 
-            direction = _find_text(curve, "Grandeur_Metier")
-            if direction == "CONS":
-                direction = "consumption"
-            elif direction == "PROD":
-                direction = "production"
+            yield meta, record
 
-            measurement = _find_text(curve, "Grandeur_Physique")
-            if measurement == "EA":
-                name = "power/active"
-                assert unit == "kW"
-                unit = "W"  # Value will be converted
-                meta: Metadata = MetadataEnedisConsumptionPowerActiveRaw(
-                    usage_point, self.SAMPLING_INTERVAL
-                )
-            elif measurement == "ERC":
-                name = "power/capacitive"
-                # TODO seems to be kVAr
-                # assert unit == "kWr"
-                unit = "Wr"  # Value will be converted
-                meta = MetadataEnedisConsumptionPowerCapacitiveRaw(
-                    usage_point, self.SAMPLING_INTERVAL
-                )
-            elif measurement == "ERI":
-                # TODO seems to be kVAr
-                # assert unit == "kWr"
-                unit = "Wr"  # Value will be converted
-                name = "power/inductive"
-                meta = MetadataEnedisConsumptionPowerInductiveRaw(
-                    usage_point, self.SAMPLING_INTERVAL
-                )
-            elif measurement == "E":
-                name = "voltage"
-                meta = MetadataEnedisConsumptionVoltageRaw(
-                    usage_point, self.SAMPLING_INTERVAL
-                )
-            else:
-                raise RuntimeError(f"Unexpected Grandeur {name}")
-
-            name = f"urn:dev:prm:{usage_point}_{direction}/{name}/{nature}"
-
-            for point in curve.findall("./Donnees_Point_Mesure"):
-
-                datetime = dt.datetime.fromisoformat(point.attrib["Horodatage"])
-                value = int(point.attrib["Valeur_Point"])
-                status = point.attrib["Statut_Point"]
-
-                if status != "R":
-                    # R : Réel
-                    # H : Puissance reconstituée
-                    # P : Puissance reconstituée et Coupure Secteur
-                    # S : Coupure secteur
-                    # T : Coupure Secteur courte
-                    # F : Début coupure secteur
-                    # G : Fin de coupure secteur
-                    # E : Estimé
-                    # C : Corrigé
-                    # K : Calculé, point de courbe issu d’un calcul basé sur
-                    #     d’autres courbes de charges
-                    # D : importé manuellement par le métier Enedis
-                    logging.warn(f"status {status} is not handled yet")
-                    continue
-
-                if measurement in ["EA", "ERC", "ERI"]:
-                    # sge tiers proxy uses W, not kW
-                    value = value * 1000
-
-                record = Record(name, datetime, unit, value)
-
-                yield meta, record
+        for status, count in skipped.items():
+            logging.warning(
+                "status %s is not handled yet (%s, %d points skipped)",
+                status,
+                name,
+                count,
+            )
@@ -1,6 +1,7 @@
 import unittest
+import re
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.exc import IntegrityError, StatementError
 from sqlalchemy.orm import sessionmaker
 from sgeproxy.db import (
@@ -17,9 +18,10 @@ from sgeproxy.db import (
 
 import datetime as dt
 
-# Database and access rights need to be initialized before running tests:
+# Database and access rights need to be initialized before running tests,
+# migrations are UTF-8 encoded so the database must be too:
 # sudo -u postgres psql
-# CREATE DATABASE sgeproxy_test;
+# CREATE DATABASE sgeproxy_test ENCODING 'UTF8' TEMPLATE template0;
 # CREATE USER sgeproxy_test WITH ENCRYPTED PASSWORD 'password';
 # GRANT ALL PRIVILEGES ON DATABASE sgeproxy_test TO sgeproxy_test;
 # \c sgeproxy_test
@@ -31,6 +33,35 @@ class Args:
     db_url = None
 
 
+# Shared by all tests, along with its connection pool
+engine = None
+# Sessions are bound to each test connection when created
+Session = sessionmaker()
+
+
+def setUpModule():
+    global engine
+    # Tests that do not use the database can still run without it
+    if Args.db_url is not None:
+        # Batches UPDATE and DELETE too, not only INSERT (the 1.4 default)
+        engine = create_engine(Args.db_url, executemany_mode="values_plus_batch")
+
+        # Test data is not worth waiting for the WAL to be flushed to disk
+        @event.listens_for(engine, "connect")
+        def disable_synchronous_commit(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SET SESSION synchronous_commit = off")
+            cursor.close()
+            # Or the pool would roll the setting back with the transaction
+            # psycopg2 opened for it
+            dbapi_connection.commit()
+
+
+def tearDownModule():
+    if engine is not None:
+        engine.dispose()
+
+
 class TestDbMigrations(unittest.TestCase):
     def test_migrations_update_in_db_version_correctly(self):
         """
@@ -38,8 +69,6 @@ class TestDbMigrations(unittest.TestCase):
         setting the current state (version) correctly.
         """
 
-        engine = create_engine(Args.db_url)
-
         with engine.connect() as con:
 
             con.execute("DROP SCHEMA public CASCADE")
@@ -50,27 +79,26 @@ class TestDbMigrations(unittest.TestCase):
             latest_version, _ = Migration.files()[-1]
             self.assertEqual(latest_version, Migration.deployed_version(con))
 
+
+# Checks migration files without running them, no database is needed
+class TestMigrationSql(unittest.TestCase):
+    # Any TIMESTAMP type not followed by WITH TIME ZONE, SQL keywords are
+    # ASCII so files do not need to be decoded
+    NAIVE_TIMESTAMP = re.compile(
+        rb"\sTIMESTAMP(?!\s+WITH\s+TIME\s+ZONE\b)", re.IGNORECASE
+    )
+
     def test_timestamps_are_not_naive(self):
         for _, file in Migration.files():
-            with open(file, "r") as f:
+            with open(file, "rb") as f:
                 sql = f.read()
-                sql = sql.upper()
-                sql = " ".join(sql.split())
-                start = 0
-                expected_seq = " TIMESTAMP WITH TIME ZONE"
-                while True:
-                    start = sql.find(" TIMESTAMP", start)
-                    if start < 0:
-                        break
-                    found_seq = sql[start : start + len(expected_seq)]
-                    self.assertEqual(expected_seq, found_seq)
-                    start += len(expected_seq)
+                found = [m.start() for m in self.NAIVE_TIMESTAMP.finditer(sql)]
+                self.assertEqual([], found, f"Naive timestamps in {file}, at offsets")
 
 
 class TestDbConsents(unittest.TestCase):
-    def setUp(self):
-
-        engine = create_engine(Args.db_url)
+    @classmethod
+    def setUpClass(cls):
 
         with engine.connect() as con:
 
@@ -79,17 +107,28 @@ class TestDbConsents(unittest.TestCase):
 
             Migration.migrate(con)
 
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
+    def setUp(self):
+
+        # Each test runs in a transaction rolled back by tearDown, so the
+        # schema is only migrated once. The session works in a savepoint,
+        # restarted whenever the session commits or rolls back, so tests can
+        # still commit and expect constraint violations.
+        self.connection = engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = Session(bind=self.connection)
+        self.nested = self.connection.begin_nested()
+
+        @event.listens_for(self.session, "after_transaction_end")
+        def restart_savepoint(session, transaction):
+            if not self.nested.is_active:
+                self.nested = self.connection.begin_nested()
 
         # Homer Simpson gave its consent to Alice,
         # allowing her to access his consumption data.
 
         self.alice = User(bare_jid="alice@wonderland.lit")
-        self.session.add(self.alice)
 
         self.homer_usage_point = UsagePoint(id="09111642617347")
-        self.session.add(self.homer_usage_point)
 
         self.homer_consent_to_alice = Consent(
             issuer_name="Simpson",
@@ -100,7 +139,6 @@ class TestDbConsents(unittest.TestCase):
         self.homer_consent_to_alice.usage_points.append(
             ConsentUsagePoint(usage_point=self.homer_usage_point, comment="Home")
         )
-        self.session.add(self.homer_consent_to_alice)
 
         self.alice.consents.append(self.homer_consent_to_alice)
 
@@ -108,10 +146,8 @@ class TestDbConsents(unittest.TestCase):
         # allowing her to access his production data
 
         self.sister = User(bare_jid="sister@realworld.lit")
-        self.session.add(self.sister)
 
         self.burns_usage_point = UsagePoint(id="30001642617347")
-        self.session.add(self.burns_usage_point)
 
         self.burns_consent_to_sister = Consent(
             issuer_name="The Springfield Nuclear Power Plant",
@@ -122,14 +158,25 @@ class TestDbConsents(unittest.TestCase):
         self.burns_consent_to_sister.usage_points.append(
             ConsentUsagePoint(usage_point=self.burns_usage_point, comment="Reactor #1")
         )
-        self.session.add(self.burns_consent_to_sister)
 
         self.sister.consents.append(self.burns_consent_to_sister)
 
+        self.session.add_all(
+            [
+                self.alice,
+                self.homer_usage_point,
+                self.homer_consent_to_alice,
+                self.sister,
+                self.burns_usage_point,
+                self.burns_consent_to_sister,
+            ]
+        )
         self.session.commit()
 
     def tearDown(self):
         self.session.close()
+        self.transaction.rollback()
+        self.connection.close()
 
     def test_naive_datetimes_are_not_allowed(self):
         consent = Consent(
@@ -154,133 +201,77 @@ class TestDbConsents(unittest.TestCase):
 
         self.session.commit()
 
-    def test_db_denies_call_with_no_consent(self):
+    def test_db_denies_calls_out_of_consent_scope(self):
 
-        WebservicesCall(
+        homer_call = dict(
             usage_point=self.homer_usage_point,
-            consent=None,
-            user=self.alice,
-            webservice="ConsultationMesures",
-            called_at=date_local(2020, 1, 2),
-        )
-
-        with self.assertRaises(IntegrityError):
-            self.session.commit()
-
-    def test_db_denies_call_for_an_out_of_scope_usage_point(self):
-        """
-        Homer consent does not allow to access Burns usage point data.
-        """
-        WebservicesCall(
-            usage_point=self.burns_usage_point,
             consent=self.homer_consent_to_alice,
             user=self.alice,
             webservice="ConsultationMesures",
             called_at=date_local(2020, 1, 2),
         )
 
-        with self.assertRaises(IntegrityError) as context:
-            self.session.commit()
-
-        self.assertTrue(
-            'is not present in table "consents_usage_points"' in str(context.exception)
-        )
-
-    def test_db_denies_call_with_no_usage_point(self):
-
-        WebservicesCall(
-            usage_point=None,
-            consent=self.homer_consent_to_alice,
-            user=self.alice,
-            webservice="ConsultationMesures",
-            called_at=date_local(2020, 1, 2),
-        )
-
-        with self.assertRaises(IntegrityError):
-            self.session.commit()
-
-    def test_db_denies_call_for_an_out_of_scope_user(self):
-        """
-        Alice cannot use consent from Burns (given to sister).
-        """
-
-        WebservicesCall(
-            usage_point=self.burns_usage_point,
-            consent=self.burns_consent_to_sister,
-            user=self.alice,
-            webservice="ConsultationMesures",
-            called_at=date_local(2020, 1, 2),
-        )
-
-        with self.assertRaises(IntegrityError) as context:
-            self.session.commit()
-
-        self.assertTrue(
-            'is not present in table "consents_users"' in str(context.exception)
-        )
-
-    def test_db_denies_call_with_no_user(self):
-        WebservicesCall(
-            usage_point=self.burns_usage_point,
-            consent=self.burns_consent_to_sister,
-            user=None,
-            webservice="ConsultationMesures",
-            called_at=date_local(2020, 1, 2),
-        )
-
-        with self.assertRaises(IntegrityError):
-            self.session.commit()
-
-    def test_db_denies_call_for_a_too_early_date(self):
-        """
-        Alice cannot access data before the period of time Homer consented to.
-        """
-
-        WebservicesCall(
-            usage_point=self.homer_usage_point,
-            consent=self.homer_consent_to_alice,
-            user=self.alice,
-            webservice="ConsultationMesures",
-            called_at=date_local(2019, 1, 2),
-        )
-
-        with self.assertRaises(IntegrityError) as context:
-            self.session.commit()
-
-        self.assertTrue("violates check constraint" in str(context.exception))
-
-    def test_db_denies_call_for_a_too_late_date(self):
-        """
-        Alice cannot access data after the period of time Homer consented to.
-        """
-
-        WebservicesCall(
-            usage_point=self.homer_usage_point,
-            consent=self.homer_consent_to_alice,
-            user=self.alice,
-            webservice="ConsultationMesures",
-            called_at=date_local(2022, 1, 2),
-        )
-
-        with self.assertRaises(IntegrityError) as context:
-            self.session.commit()
-
-        self.assertTrue("violates check constraint" in str(context.exception))
+        # Each case overrides a valid call, and the error message is checked
+        # when given
+        cases = [
+            ("no consent", dict(consent=None), None),
+            # Homer consent does not allow to access Burns usage point data.
+            (
+                "out of scope usage point",
+                dict(usage_point=self.burns_usage_point),
+                'is not present in table "consents_usage_points"',
+            ),
+            ("no usage point", dict(usage_point=None), None),
+            # Alice cannot use consent from Burns (given to sister).
+            (
+                "out of scope user",
+                dict(
+                    usage_point=self.burns_usage_point,
+                    consent=self.burns_consent_to_sister,
+                ),
+                'is not present in table "consents_users"',
+            ),
+            (
+                "no user",
+                dict(
+                    usage_point=self.burns_usage_point,
+                    consent=self.burns_consent_to_sister,
+                    user=None,
+                ),
+                None,
+            ),
+            # Alice cannot access data out of the period of time Homer
+            # consented to.
+            (
+                "too early date",
+                dict(called_at=date_local(2019, 1, 2)),
+                "violates check constraint",
+            ),
+            (
+                "too late date",
+                dict(called_at=date_local(2022, 1, 2)),
+                "violates check constraint",
+            ),
+            ("no date", dict(called_at=None), "violates check constraint"),
+        ]
 
-    def test_db_denies_call_with_no_date(self):
+        for case, overrides, message in cases:
+            with self.subTest(case):
 
-        WebservicesCall(
-            usage_point=self.homer_usage_point,
-            consent=self.homer_consent_to_alice,
-            user=self.alice,
-            webservice="ConsultationMesures",
-            called_at=None,
-        )
+                try:
+                    WebservicesCall(**{**homer_call, **overrides})
 
-        with self.assertRaises(IntegrityError) as context:
-            self.session.commit()
+                    # Constraints are not deferred, they are checked on flush.
+                    # Unlike a commit, which releases the savepoint, a flush
+                    # is undone by the rollback even if the call is accepted.
+                    with self.assertRaises(IntegrityError) as context:
+                        self.session.flush()
+                finally:
+                    # Back to the fixtures for the next case
+                    self.session.rollback()
 
-        self.assertTrue("violates check constraint" in str(context.exception))
+                if message is not None:
+                    self.assertTrue(message in str(context.exception))
 
     def test_db_denies_updating_consent_user_if_it_breaks_a_call_constraint(self):
         """
@@ -361,6 +352,40 @@ class TestDbConsents(unittest.TestCase):
         )
         self.assertEqual(consent, self.burns_consent_to_sister)
 
+    def test_db_find_consents_among_successive_ones(self):
+        """
+        Homer renewed his consent to Alice when the first one expired.
+        """
+
+        renewed_consent = Consent(
+            issuer_name="Simpson",
+            issuer_type="male",
+            begins_at=date_local(2021, 1, 1),
+            expires_at=date_local(2022, 1, 1),
+        )
+        renewed_consent.usage_points.append(
+            ConsentUsagePoint(usage_point=self.homer_usage_point, comment="Home")
+        )
+        self.alice.consents.append(renewed_consent)
+        self.session.commit()
+
+        consent = self.alice.consent_for(
+            self.session, self.homer_usage_point, date_local(2020, 6, 1)
+        )
+        self.assertEqual(consent, self.homer_consent_to_alice)
+
+        consent = self.alice.consent_for(
+            self.session, self.homer_usage_point, date_local(2021, 6, 1)
+        )
+        self.assertEqual(consent, renewed_consent)
+
+        with self.assertRaises(PermissionError) as context:
+            self.alice.consent_for(
+                self.session, self.homer_usage_point, date_local(2022, 1, 1)
+            )
+
+        self.assertTrue("is no longer valid" in str(context.exception))
+
     def test_db_throws_exception_when_no_consent_given_for_usage_point(self):
 
         with self.assertRaises(PermissionError) as context:
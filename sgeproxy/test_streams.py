@@ -1,7 +1,13 @@
 import unittest
+import io
 import os
+import subprocess
+import tempfile
+import zipfile
+import datetime as dt
 
 from sgeproxy.publisher import RecordsByName, StreamsFiles
+from sgeproxy.streams import R4x, R50, R171
 from quoalise.data import Data, Metadata
 from slixmpp.xmlstream import ET
 
@@ -29,6 +35,365 @@ def day_records():
     return records_by_name
 
 
+def xml_stream(xml):
+    # Streams are parsed with iterparse, which reads from file objects too
+    return io.BytesIO(xml.encode())
+
+
+def r50_stream(prms):
+    xml_prms = ""
+    for usage_point, points in prms:
+        pdcs = "".join(
+            f"<PDC><H>{time}</H><V>{value}</V><IV>0</IV></PDC>"
+            for time, value in points
+        )
+        xml_prms += (
+            f"<PRM><Id_PRM>{usage_point}</Id_PRM>"
+            f"<Donnees_Releve>{pdcs}</Donnees_Releve></PRM>"
+        )
+    return xml_stream(
+        "<R50><En_Tete_Flux><Pas_Publication>30</Pas_Publication></En_Tete_Flux>"
+        f"{xml_prms}</R50>"
+    )
+
+
+class TestR50(unittest.TestCase):
+    def test_records_are_stamped_at_period_begining(self):
+
+        stream = r50_stream(
+            [
+                (
+                    "30001444954220",
+                    [
+                        ("2023-01-15T00:30:00+01:00", 100),
+                        ("2023-01-15T01:00:00+01:00", 101),
+                        ("2023-01-15T01:30:00+01:00", 102),
+                        # Missing points are allowed
+                        ("2023-01-15T02:30:00+01:00", 104),
+                    ],
+                )
+            ]
+        )
+
+        records = [record for _, record in R50(stream).records()]
+
+        paris = dt.timezone(dt.timedelta(hours=1))
+        self.assertEqual(
+            [record.time for record in records],
+            [
+                dt.datetime(2023, 1, 15, 0, 0, tzinfo=paris),
+                dt.datetime(2023, 1, 15, 0, 30, tzinfo=paris),
+                dt.datetime(2023, 1, 15, 1, 0, tzinfo=paris),
+                dt.datetime(2023, 1, 15, 2, 0, tzinfo=paris),
+            ],
+        )
+        self.assertEqual([record.value for record in records], [100, 101, 102, 104])
+
+    def test_unexpected_period_is_rejected(self):
+
+        stream = r50_stream(
+            [
+                (
+                    "30001444954220",
+                    [
+                        ("2023-01-15T00:30:00+01:00", 100),
+                        ("2023-01-15T00:40:00+01:00", 101),
+                    ],
+                )
+            ]
+        )
+
+        with self.assertRaises(AssertionError):
+            list(R50(stream).records())
+
+    def test_unexpected_period_rejects_whole_prm(self):
+
+        stream = r50_stream(
+            [
+                (
+                    "30001444954220",
+                    [
+                        ("2023-01-15T00:30:00+01:00", 100),
+                        ("2023-01-15T01:00:00+01:00", 101),
+                    ],
+                ),
+                (
+                    "30001444954221",
+                    [
+                        ("2023-01-15T00:30:00+01:00", 200),
+                        ("2023-01-15T00:40:00+01:00", 201),
+                        ("2023-01-15T00:50:00+01:00", 202),
+                    ],
+                ),
+            ]
+        )
+
+        records = []
+        with self.assertRaises(AssertionError):
+            for _, record in R50(stream).records():
+                records.append(record)
+
+        # Points of the rejected PRM are not yielded before the error
+        self.assertEqual([record.value for record in records], [100, 101])
+
+    def test_off_grid_point_is_tolerated(self):
+
+        stream = r50_stream(
+            [
+                (
+                    "30001444954220",
+                    [
+                        ("2023-01-15T00:30:00+01:00", 100),
+                        ("2023-01-15T01:00:00+01:00", 101),
+                    ],
+                ),
+                (
+                    "30001444954221",
+                    [
+                        ("2023-01-15T00:30:00+01:00", 200),
+                        ("2023-01-15T01:00:00+01:00", 201),
+                        ("2023-01-15T01:10:00+01:00", 202),
+                        ("2023-01-15T01:30:00+01:00", 203),
+                        ("2023-01-15T02:00:00+01:00", 204),
+                        ("2023-01-15T02:30:00+01:00", 205),
+                    ],
+                ),
+            ]
+        )
+
+        records = [record for _, record in R50(stream).records()]
+
+        self.assertEqual(
+            [record.value for record in records],
+            [100, 101, 200, 201, 202, 203, 204, 205],
+        )
+
+
+def r171_stream(series):
+    xml_series = ""
+    for direction, code, unit, temporal_class, measurements in series:
+        xml_measurements = "".join(
+            f"<mesureDatee><dateFin>{time}</dateFin><valeur>{value}</valeur>"
+            "</mesureDatee>"
+            for time, value in measurements
+        )
+        xml_series += (
+            "<serieMesuresDatees><prmId>30001444954220</prmId>"
+            f"<grandeurMetier>{direction}</grandeurMetier>"
+            f"<grandeurPhysique>{code}</grandeurPhysique>"
+            "<typeCalendrier>D</typeCalendrier>"
+            f"<codeClasseTemporelle>{temporal_class}</codeClasseTemporelle>"
+            f"<unite>{unit}</unite>"
+            f"<mesuresDatees>{xml_measurements}</mesuresDatees>"
+            "</serieMesuresDatees>"
+        )
+    return xml_stream(
+        "<R171><serieMesuresDateesListe>"
+        f"{xml_series}"
+        "</serieMesuresDateesListe></R171>"
+    )
+
+
+class TestR171(unittest.TestCase):
+    def test_computed_records(self):
+
+        stream = r171_stream(
+            [
+                ("CONS", "PMA", "VA", "HPH", [("2023-01-15T00:00:00", 10)]),
+                ("CONS", "PMA", "VA", "HCH", [("2023-01-15T00:00:00", 12)]),
+                ("CONS", "EA", "Wh", "HPH", [("2023-01-15T00:00:00", 100)]),
+                ("CONS", "EA", "Wh", "HCH", [("2023-01-15T00:00:00", 200)]),
+                # Production is not used for computed records, and does not
+                # expect them for times only it measures
+                ("PROD", "EA", "Wh", "HPH", [("2023-01-16T00:00:00", 300)]),
+            ],
+        )
+
+        values = {record.name: record.value for _, record in R171(stream).records()}
+
+        base_name = "urn:dev:prm:30001444954220_consumption"
+        self.assertEqual(values[base_name + "/power/apparent/max"], 12)
+        self.assertEqual(values[base_name + "/energy/active/index"], 300)
+        self.assertEqual(len(values), 7)
+
+
+def r4x_stream(curves, header=True):
+    xml_curves = ""
+    for code, unit, points in curves:
+        xml_points = ""
+        for time, value, status in points:
+            # Gap points come without a value
+            value = "" if value is None else f' Valeur_Point="{value}"'
+            xml_points += (
+                f'<Donnees_Point_Mesure Horodatage="{time}"{value}'
+                f' Statut_Point="{status}"/>'
+            )
+        xml_curves += (
+            "<Donnees_Courbe><Granularite>10</Granularite>"
+            f"<Unite_Mesure>{unit}</Unite_Mesure>"
+            "<Grandeur_Metier>CONS</Grandeur_Metier>"
+            f"<Grandeur_Physique>{code}</Grandeur_Physique>"
+            f"{xml_points}"
+            "</Donnees_Courbe>"
+        )
+    xml_header = (
+        "<Entete><Identifiant_PRM>00000000000000</Identifiant_PRM>"
+        "<Nature_De_Courbe_Demandee>Brute</Nature_De_Courbe_Demandee></Entete>"
+    )
+    return xml_stream(
+        "<Courbe>"
+        f"{xml_header if header else ''}"
+        "<Corps><Identifiant_PRM>30001444954220</Identifiant_PRM>"
+        f"{xml_curves}"
+        "</Corps></Courbe>"
+    )
+
+
+class TestR4x(unittest.TestCase):
+    def test_records(self):
+
+        stream = r4x_stream(
+            [
+                ("EA", "kW", [("2023-01-15T00:00:00+01:00", 1, "R")]),
+                ("ERC", "kVAr", [("2023-01-15T00:00:00+01:00", 2, "R")]),
+                ("ERI", "kVAr", [("2023-01-15T00:00:00+01:00", 3, "R")]),
+                ("E", "V", [("2023-01-15T00:00:00+01:00", 230, "R")]),
+            ],
+        )
+
+        records = {record.name: record for _, record in R4x(stream).records()}
+
+        # Usage point is taken from Corps, not from the header
+        base_name = "urn:dev:prm:30001444954220_consumption"
+        self.assertEqual(
+            [(name, record.unit, record.value) for name, record in records.items()],
+            [
+                # Powers are converted from kW to W
+                (base_name + "/power/active/raw", "W", 1000),
+                (base_name + "/power/capacitive/raw", "Wr", 2000),
+                (base_name + "/power/inductive/raw", "Wr", 3000),
+                # Voltage is given as is
+                (base_name + "/voltage/raw", "V", 230),
+            ],
+        )
+
+    def test_only_real_points_are_kept(self):
+
+        stream = r4x_stream(
+            [
+                (
+                    "EA",
+                    "kW",
+                    [
+                        ("2023-01-15T00:00:00+01:00", 1, "R"),
+                        ("2023-01-15T00:10:00+01:00", 2, "E"),
+                        # Power outage, no value given
+                        ("2023-01-15T00:20:00+01:00", None, "S"),
+                        ("2023-01-15T00:30:00+01:00", 4, "R"),
+                    ],
+                ),
+            ],
+        )
+
+        with self.assertLogs(level="WARNING") as logs:
+            records = [record for _, record in R4x(stream).records()]
+
+        self.assertEqual([record.value for record in records], [1000, 4000])
+        self.assertEqual(len(logs.records), 2)
+
+    def test_missing_header_is_rejected(self):
+
+        stream = r4x_stream(
+            [("EA", "kW", [("2023-01-15T00:00:00+01:00", 1, "R")])],
+            header=False,
+        )
+
+        with self.assertRaises(AssertionError) as context:
+            list(R4x(stream).records())
+
+        self.assertEqual(str(context.exception), "Missing Entete")
+
+
+# Dummy key and iv to encrypt stream files written by tests
+TEST_AES_IV = "000102030405060708090a0b0c0d0e0f"
+TEST_AES_KEY = "00112233445566778899aabbccddeeff"
+
+
+def truncated(stream, tag):
+    # Cut the document in the middle of the last element named tag
+    xml = stream.getvalue()
+    return xml[: xml.rindex(f"<{tag}>".encode()) + len(tag) + 4]
+
+
+class TestStreamsFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.streams_files = StreamsFiles(
+            inbox_dir=os.path.join(self.directory.name, "inbox"),
+            archive_dir=os.path.join(self.directory.name, "archive"),
+            errors_dir=os.path.join(self.directory.name, "errors"),
+            aes_iv=TEST_AES_IV,
+            aes_key=TEST_AES_KEY,
+        )
+        os.makedirs(self.streams_files.inbox_dir)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def inbox_file(self, filename, xml):
+        zip_path = os.path.join(self.directory.name, filename)
+        with zipfile.ZipFile(zip_path, "w") as zip_file:
+            zip_file.writestr(filename[: -len(".zip")] + ".xml", xml)
+        path = os.path.join(self.streams_files.inbox_dir, filename)
+        subprocess.run(
+            [
+                "openssl",
+                "enc",
+                "-aes-128-cbc",
+                "-K",
+                TEST_AES_KEY,
+                "-iv",
+                TEST_AES_IV,
+                "-in",
+                zip_path,
+                "-out",
+                path,
+            ],
+            check=True,
+        )
+        return path
+
+    def assertNothingYielded(self, path):
+        records = []
+        with self.assertRaises(ET.ParseError):
+            for record in self.streams_files.file_records(path):
+                records.append(record)
+        self.assertEqual(records, [])
+        # Left in inbox for the caller to move it to errors
+        self.assertTrue(os.path.exists(path))
+
+    def test_truncated_r171_yields_nothing(self):
+
+        series = ("CONS", "EA", "Wh", "HPH", [("2023-01-15T00:00:00", 100)])
+        xml = truncated(r171_stream([series, series]), "mesureDatee")
+
+        self.assertNothingYielded(self.inbox_file("ENEDIS_R171_test.zip", xml))
+
+    def test_truncated_r4x_yields_nothing(self):
+
+        curve = ("EA", "kW", [("2023-01-15T00:00:00+01:00", 1, "R")])
+        xml = truncated(r4x_stream([curve, curve]), "Donnees_Courbe")
+
+        self.assertNothingYielded(self.inbox_file("ENEDIS_23X_R4Q_CDC_test.zip", xml))
+
+    def test_truncated_r50_yields_nothing(self):
+
+        prm = ("30001444954220", [("2023-01-15T00:30:00+01:00", 100)])
+        xml = truncated(r50_stream([prm, prm]), "PRM")
+
+        self.assertNothingYielded(self.inbox_file("ERDF_R50_test.zip", xml))
+
+
 class TestStreams(unittest.TestCase):
     def test_day_all(self):
 